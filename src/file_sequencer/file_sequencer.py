@@ -1,8 +1,16 @@
-import importlib.util as importlib
+import ast
+import codecs
+import functools
 import os
 import logging
+import operator
+import re
 import sys
-from typing import Generator, List, Dict, Any, Tuple
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple, Union
 import logging
 
 __author__ = "Barry Fourie"
@@ -11,17 +19,357 @@ __license__ = "MIT"
 
 _logger = logging.getLogger(__name__)
 
+_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+_READ_BUFFER_SIZE = 65536
+
+_SUPPORTS_OPEN_DIR_FD = os.open in os.supports_dir_fd
+
+_SUPPORTS_RENAME_DIR_FD = os.rename in os.supports_dir_fd
+
+_REVISION_CACHE_SIZE = 4096
+
+_revision_cache = OrderedDict()
+
+_revision_cache_lock = threading.Lock()
+
+_read_buffers = threading.local()
+
+_REVISION_KEYS = ("revision_id", "revises_id")
+
+_by_revision_count = operator.attrgetter("revision_count")
+
+_by_filename = operator.itemgetter(0)
+
+# Matches top-level ``revision_id = '...'`` / ``revises_id = None`` style assignments.
+# Escaped literals are left to the ast fallback.
+_REVISION_PATTERN = re.compile(
+    rb"^(revision_id|revises_id)[ \t]*=[ \t]*"
+    rb"(None|'([^'\\\n]*)'|\"([^\"\\\n]*)\")[ \t]*(?:#.*)?\r?$",
+    re.M,
+)
+
+# Matches any line starting with a revision key, however it is assigned.
+_REVISION_LINE_PATTERN = re.compile(rb"^(?:revision_id|revises_id)\b", re.M)
+
+# Triple-quote delimiters that are not escaped with a backslash.
+_TRIPLE_QUOTE_PATTERN = re.compile(rb"(?<!\\)(?:\"\"\"|''')")
+
+# PEP 263 encoding declaration on the first or second line.
+_CODING_PATTERN = re.compile(
+    rb"\A(?:[^\n]*\n)?[ \t\f]*#[^\n]*?coding[:=][ \t]*([-\w.]+)"
+)
+
+
+def _match_revision_data(source: Union[bytes, memoryview]) -> Dict[str, Any]:
+    """Scan the source for simple top-level revision assignments in a single pass.
+    Lines inside triple-quoted strings such as docstrings are skipped. Nothing is
+    returned when a revision line is not a simple assignment or when the file is not
+    UTF-8 encoded.
+
+    Args:
+        source (Union[bytes, memoryview]): Raw contents of the Python file.
+
+    Returns:
+        Dict[str, Any]: The revision values that were found, keyed by name.
+    """
+    coding = _CODING_PATTERN.match(source)
+    if coding is not None:
+        try:
+            if codecs.lookup(coding.group(1).decode("ascii")).name != "utf-8":
+                return {}
+        except (LookupError, UnicodeDecodeError):
+            return {}
+
+    values = {}
+    string_spans = _triple_quoted_spans(source)
+    for line in _REVISION_LINE_PATTERN.finditer(source):
+        start = line.start()
+        if any(span_start < start < span_end for span_start, span_end in string_spans):
+            continue
+        match = _REVISION_PATTERN.match(source, start)
+        if match is None:
+            return {}
+        key, literal, single_quoted, double_quoted = match.groups()
+        if literal == b"None":
+            values[key.decode()] = None
+        else:
+            value = single_quoted if single_quoted is not None else double_quoted
+            try:
+                values[key.decode()] = value.decode("utf-8")
+            except UnicodeDecodeError:
+                return {}
+    return values
+
+
+def _triple_quoted_spans(source: Union[bytes, memoryview]) -> List[Tuple[int, int]]:
+    """Find the spans of the triple-quoted strings in the source. Each string runs from
+    its opening delimiter to the next matching one, or to the end of an unterminated
+    string.
+
+    Args:
+        source (Union[bytes, memoryview]): Raw contents of the Python file.
+
+    Returns:
+        List[Tuple[int, int]]: Start and end offsets of each triple-quoted string.
+    """
+    spans = []
+    opening = None
+    for delimiter in _TRIPLE_QUOTE_PATTERN.finditer(source):
+        if opening is None:
+            opening = delimiter
+        elif delimiter.group() == opening.group():
+            spans.append((opening.start(), delimiter.end()))
+            opening = None
+    if opening is not None:
+        spans.append((opening.start(), len(source)))
+    return spans
+
+
+def _parse_revision_data(source: bytes) -> Dict[str, Any]:
+    """Parse the source and read the revision values from top-level constant
+    assignments, including tuple unpacking. A later assignment that is not a
+    constant, such as ``revision_id += "x"``, discards any earlier value.
+
+    Args:
+        source (bytes): Raw contents of the Python file.
+
+    Returns:
+        Dict[str, Any]: The revision values that were found, keyed by name.
+    """
+    values = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.Assign):
+            bindings = [
+                binding
+                for target in node.targets
+                for binding in _revision_bindings(target, node.value)
+            ]
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            bindings = _revision_bindings(node.target, node.value)
+        elif isinstance(node, ast.AugAssign):
+            bindings = _revision_bindings(node.target, None)
+        else:
+            continue
+        for name, value in bindings:
+            if isinstance(value, ast.Constant):
+                values[name] = value.value
+            else:
+                values.pop(name, None)
+    return values
+
+
+def _revision_bindings(
+    target: ast.expr, value: Optional[ast.expr]
+) -> List[Tuple[str, Optional[ast.expr]]]:
+    """Pair each revision name bound by an assignment target with the expression it is
+    assigned. Tuple targets are matched element-wise against a tuple value of the same
+    length; otherwise the names get None, as their value is not known.
+
+    Args:
+        target (ast.expr): Target of the assignment.
+        value (ast.expr, optional): Value assigned to the target, if known.
+
+    Returns:
+        List[Tuple[str, Optional[ast.expr]]]: Revision names and their assigned values.
+    """
+    if isinstance(target, ast.Name):
+        return [(target.id, value)] if target.id in _REVISION_KEYS else []
+    if isinstance(target, (ast.Tuple, ast.List)):
+        if (
+            isinstance(value, (ast.Tuple, ast.List))
+            and len(value.elts) == len(target.elts)
+            and not any(isinstance(elt, ast.Starred) for elt in target.elts)
+        ):
+            return [
+                binding
+                for elt, elt_value in zip(target.elts, value.elts)
+                for binding in _revision_bindings(elt, elt_value)
+            ]
+        return [
+            (node.id, None)
+            for node in ast.walk(target)
+            if isinstance(node, ast.Name) and node.id in _REVISION_KEYS
+        ]
+    return []
+
+
+def _open_directory(directory: str) -> Optional[int]:
+    """Open a directory so the files in it can be opened and renamed relative to it.
+
+    Args:
+        directory (str): Path to the directory.
+
+    Returns:
+        Optional[int]: Descriptor of the directory, or None if the platform does not
+                       support operations relative to a directory descriptor.
+    """
+    if not _SUPPORTS_OPEN_DIR_FD:
+        return None
+    return os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+
+
+def _read_source(
+    file_path: str, size: int, dir_fd: Optional[int] = None
+) -> Union[bytes, memoryview]:
+    """Read a file into this thread's reusable buffer, growing the buffer if the file
+    does not fit. The returned view is only valid until the next read on the same
+    thread.
+
+    Args:
+        file_path (str): Path to the file.
+        size (int): Expected size of the file in bytes.
+        dir_fd (int, optional): Descriptor of the directory containing the file. When
+                                given the file is opened by name relative to it.
+
+    Returns:
+        Union[bytes, memoryview]: The file contents.
+    """
+    buffer = getattr(_read_buffers, "buffer", None)
+    if buffer is None or len(buffer) <= size:
+        buffer = bytearray(max(_READ_BUFFER_SIZE, size + 1))
+        _read_buffers.buffer = buffer
+
+    view = memoryview(buffer)
+    length = 0
+    if dir_fd is None:
+        file = open(file_path, "rb", buffering=0)
+    else:
+        file_name = os.path.basename(file_path)
+        file = open(os.open(file_name, os.O_RDONLY, dir_fd=dir_fd), "rb", buffering=0)
+
+    with file:
+        while length < len(buffer):
+            count = file.readinto(view[length:])
+            if not count:
+                return view[:length]
+            length += count
+
+        # The file grew after it was stat'ed, read the rest as a bytes object
+        return bytes(view) + file.readall()
+
+
+def _read_revision_data(
+    file_path: str, size: int, dir_fd: Optional[int] = None
+) -> Optional[Tuple[str, str]]:
+    """Read a Python file and extract its revision data.
+
+    Args:
+        file_path (str): Path to the Python file.
+        size (int): Size of the file in bytes.
+        dir_fd (int, optional): Descriptor of the directory containing the file.
+
+    Returns:
+        Optional[Tuple[str, str]]: revision_id and revises_id, or None if either is
+                                   missing.
+    """
+    source = _read_source(file_path, size, dir_fd)
+
+    values = _match_revision_data(source)
+    if len(values) < len(_REVISION_KEYS):
+        values = _parse_revision_data(bytes(source))
+
+    if len(values) < len(_REVISION_KEYS):
+        return None
+    return values["revision_id"], values["revises_id"]
+
+
+def _load_revision_data(
+    file_path: str, mtime_ns: int, size: int, dir_fd: Optional[int] = None
+) -> Optional[Tuple[str, str]]:
+    """Return the revision data of a Python file, reading it only when it is not cached.
+    The cache is keyed on the path, modification time and size, so a changed file is
+    read again, and dir_fd only changes how a missing entry is read. The cache is shared
+    by every RevisionSequencer in the process, and a file rewritten with the same size
+    within one modification time tick is served stale.
+
+    Args:
+        file_path (str): Path to the Python file.
+        mtime_ns (int): Modification time of the file in nanoseconds.
+        size (int): Size of the file in bytes.
+        dir_fd (int, optional): Descriptor of the directory containing the file.
+
+    Returns:
+        Optional[Tuple[str, str]]: revision_id and revises_id, or None if either is
+                                   missing.
+    """
+    key = (file_path, mtime_ns, size)
+    with _revision_cache_lock:
+        if key in _revision_cache:
+            _revision_cache.move_to_end(key)
+            return _revision_cache[key]
+
+    revision_data = _read_revision_data(file_path, size, dir_fd)
+
+    with _revision_cache_lock:
+        _revision_cache[key] = revision_data
+        if len(_revision_cache) > _REVISION_CACHE_SIZE:
+            _revision_cache.popitem(last=False)
+    return revision_data
+
+
+class RevisionNode:
+    """A file in the revision tree, linked to the files that revise it."""
+
+    __slots__ = (
+        "filename",
+        "revision_id",
+        "revises_id",
+        "revisions",
+        "revision_count",
+        "new_filename",
+    )
+
+    def __init__(self, filename: str, revision_id: str, revises_id: Optional[str]):
+        self.filename = filename
+        self.revision_id = revision_id
+        self.revises_id = revises_id
+        self.revisions: List["RevisionNode"] = []
+        self.revision_count = 0
+        self.new_filename: Optional[str] = None
+
+    @classmethod
+    def from_file(cls, file: Dict[str, Any]) -> "RevisionNode":
+        """Create a node from a dictionary returned by
+        `RevisionSequencer.process_files`.
+
+        Args:
+            file (Dict[str, Any]): Dictionary containing filename, revision_id and
+                                   revises_id.
+
+        Returns:
+            RevisionNode: The node, without any revisions.
+        """
+        return cls(file["filename"], file["revision_id"], file["revises_id"])
+
+    def __repr__(self) -> str:
+        return "RevisionNode(filename={!r}, revision_id={!r}, revises_id={!r})".format(
+            self.filename, self.revision_id, self.revises_id
+        )
+
 
 class RevisionSequencer:
     def __init__(self, directory: str):
         self.directory = directory
 
-    def extract_revision_data(self, file_path: str) -> Tuple[str, str]:
-        """Extract revision_id and revised_id from a Python file by importing it. Assumed all files are valid Python files.
-        Alternatively regex can be used to extract the data.
+    def extract_revision_data(
+        self,
+        file_path: str,
+        stat_result: Optional[os.stat_result] = None,
+        dir_fd: Optional[int] = None,
+    ) -> Tuple[str, str]:
+        """Extract revision_id and revises_id from a Python file without importing it.
+        The top-level assignments are matched with a regex, falling back to parsing the
+        source with ast when the regex does not find both values. Results are cached
+        per file path, modification time and size, so unchanged files are not re-read;
+        a same-size rewrite that keeps the modification time is not detected.
 
         Args:
             file_path (str): Path to the Python file.
+            stat_result (os.stat_result, optional): Stat of the file if already known,
+                                                    otherwise the file is stat'ed.
+            dir_fd (int, optional): Descriptor of the directory containing the file,
+                                    used to open the file by name.
 
         Raises:
             KeyError: If revision_id or revised_id is missing in the file.
@@ -30,53 +378,171 @@ class RevisionSequencer:
             Tuple[str, str]: Tuple containing revision_id and revised
         """
 
-        module_name = os.path.splitext(os.path.basename(file_path))[0]
-        spec = importlib.spec_from_file_location(module_name, file_path)
-        module = importlib.module_from_spec(spec)
-        spec.loader.exec_module(module)
+        if stat_result is None:
+            stat_result = os.stat(file_path)
 
-        if hasattr(module, "revision_id") and hasattr(module, "revises_id"):
-            revision_id = module.revision_id
-            revises_id = module.revises_id
-            return revision_id, revises_id
+        revision_data = _load_revision_data(
+            file_path, stat_result.st_mtime_ns, stat_result.st_size, dir_fd
+        )
+
+        if revision_data is not None:
+            return revision_data
         else:
             error_message = "Missing revision_id or revised_id in {}".format(file_path)
             _logger.error(error_message, exc_info=False)
             raise KeyError(error_message)
 
-    def process_files(self) -> Generator[Dict[str, Any], None, None]:
+    def process_files(self) -> List[Dict[str, Any]]:
         """Process all Python files in the directory and extract revision data.
-        Returns a generator of dictionaries containing filename, revision_id and revised_id.
+        Returns a list of dictionaries containing filename, revision_id and revised_id.
 
         Raises:
-            ValueError: If revision_id or revised_id is missing in a file.
+            ValueError: If the directory is empty or revision_id or revised_id is
+                        missing in a file.
 
-        Yields:
-            Dict[str, Any]: Dictionary containing filename, revision_id and revised_id.
+        Returns:
+            List[Dict[str, Any]]: Dictionaries containing filename, revision_id and
+                                  revised_id.
         """
 
-        for filename in os.listdir(self.directory):
-            if filename.endswith(".py"):
-                file_path = os.path.join(self.directory, filename)
+        revision_files = self._scan_revision_files()
+
+        # Files are opened relative to the directory so only their name is resolved
+        dir_fd = _open_directory(self.directory)
+        extract_one = functools.partial(self._extract_one, dir_fd=dir_fd)
+        try:
+            # Reading is I/O bound, so overlap it across threads
+            with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+                futures = [
+                    executor.submit(extract_one, revision_file)
+                    for revision_file in revision_files
+                ]
                 try:
-                    revision_id, revises_id = self.extract_revision_data(file_path)
-                    yield {
-                        "filename": filename,
-                        "revision_id": revision_id,
-                        "revises_id": revises_id,
-                    }
-                except Exception as error:
-                    warning_message = "Skipping file {} due to error {}".format(
-                        filename, error
-                    )
-                    _logger.warning(warning_message)
-                    raise ValueError(warning_message)
-
-        if len(os.listdir(self.directory)) == 0:
+                    return [future.result() for future in futures]
+                except Exception:
+                    # Stop at the first bad file rather than reading the rest
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+
+    def _extract_one(
+        self,
+        revision_file: Tuple[str, str, os.stat_result],
+        dir_fd: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """Extract the revision data for a single file found by the directory scan.
+
+        Args:
+            revision_file (Tuple[str, str, os.stat_result]): Filename, path and stat of
+                                                            the Python file.
+            dir_fd (int, optional): Descriptor of the scanned directory.
+
+        Raises:
+            ValueError: If revision_id or revised_id is missing in the file.
+
+        Returns:
+            Dict[str, Any]: Dictionary containing filename, revision_id and revised_id.
+        """
+
+        filename, file_path, stat_result = revision_file
+        try:
+            revision_id, revises_id = self.extract_revision_data(
+                file_path, stat_result, dir_fd
+            )
+        except Exception as error:
+            warning_message = "Skipping file {} due to error {}".format(filename, error)
+            _logger.warning(warning_message)
+            raise ValueError(warning_message)
+
+        return {
+            "filename": filename,
+            "revision_id": revision_id,
+            "revises_id": revises_id,
+        }
+
+    def _scan_revision_files(self) -> List[Tuple[str, str, os.stat_result]]:
+        """Collect the Python files in the directory before any of them are read.
+
+        Raises:
+            ValueError: If the directory is empty.
+
+        Returns:
+            List[Tuple[str, str, os.stat_result]]: Filename, path and stat of each
+                                                   Python file, sorted by filename.
+        """
+
+        found_entries = False
+        revision_files = []
+        add_revision_file = revision_files.append
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                found_entries = True
+                filename = entry.name
+                # Hidden and dunder entries (.git, __pycache__, __init__.py) are
+                # skipped first; the slice avoids a method call per entry
+                if filename[0] in "._":
+                    continue
+                if filename[-3:] == ".py" and entry.is_file():
+                    add_revision_file((filename, entry.path, entry.stat()))
+
+        if not found_entries:
             _logger.warning("No files found in the directory")
             raise ValueError("No files found in the directory")
 
-    def build_revision_tree(self, files_data: List[Dict[str, Any]]) -> Dict[str, Any]:
+        revision_files.sort(key=_by_filename)
+        return revision_files
+
+    def order_revisions(self, files_data: List[Dict[str, Any]]) -> List[RevisionNode]:
+        """Order the files into a single chain. When every revision is revised by at
+        most one other file the history is a linear chain and is walked directly,
+        otherwise the tree is built and flattened with `build_revision_tree` and
+        `flatten_revision_tree`.
+
+        Args:
+            files_data (List[Dict[str, Any]]): List of dictionaries containing filename,
+                                               revision_id, and revises_id.
+
+        Raises:
+            ValueError: If no root file is found.
+
+        Returns:
+            List[RevisionNode]: A flattened list of files, starting from the root,
+                                followed by its revisions.
+        """
+
+        by_parent = {file["revises_id"]: file for file in files_data}
+        revision_ids = {file["revision_id"] for file in files_data}
+
+        # A revision_id of None would lead the walk back to the root
+        if (
+            None in revision_ids
+            or len(by_parent) != len(files_data)
+            or len(revision_ids) != len(files_data)
+        ):
+            tree = self.build_revision_tree(files_data)
+            return self.flatten_revision_tree(tree)
+
+        file = by_parent.get(None)
+        if file is None:
+            _logger.error("No root file found in the directory")
+            raise ValueError("No root file found in the directory")
+
+        node = RevisionNode.from_file(file)
+        chain = [node]
+        while file["revision_id"] in by_parent:
+            file = by_parent[file["revision_id"]]
+            revision = RevisionNode.from_file(file)
+            node.revisions.append(revision)
+            node.revision_count = 1
+            chain.append(revision)
+            node = revision
+
+        return chain
+
+    def build_revision_tree(self, files_data: List[Dict[str, Any]]) -> RevisionNode:
         """
         Build an ordered tree structure where each file points to its revisions based on revises_id.
         The chain starts with the file that has no revises_id and follows each file's revision_id
@@ -86,88 +552,136 @@ class RevisionSequencer:
             files_data (List[Dict[str, Any]]): List of dictionaries containing filename, revision_id, and revises_id.
 
         Returns:
-            List[Dict[str, Any]]: A single ordered chain of files starting from the root.
+            RevisionNode: The root file, linked to its revisions.
 
         """
 
-        files_dict = {
-            file["revision_id"]: {**file, "revisions": []} for file in files_data
-        }
-
-        root = next(
-            (file for file in files_dict.values() if file["revises_id"] is None), None
-        )
-
-        if root is None:
+        # Number each revision once so the tree is linked through list positions
+        # rather than repeated revision_id lookups.
+        positions = {}
+        files = []
+        for file in files_data:
+            position = positions.setdefault(file["revision_id"], len(files))
+            if position == len(files):
+                files.append(RevisionNode.from_file(file))
+            else:
+                files[position] = RevisionNode.from_file(file)
+
+        root_position = None
+        children = [[] for _ in files]
+        for position, file in enumerate(files):
+            if file.revises_id is None:
+                if root_position is None:
+                    root_position = position
+            else:
+                parent_position = positions.get(file.revises_id)
+                if parent_position is not None:
+                    children[parent_position].append(position)
+
+        if root_position is None:
             _logger.error("No root file found in the directory")
             raise ValueError("No root file found in the directory")
 
-        def add_revisions(file):
-
-            revisions = [
-                files_dict[child["revision_id"]]
-                for child in files_data
-                if child["revises_id"] == file["revision_id"]
-            ]
-
-            for revision in revisions:
-                file["revisions"].append(revision)
-                add_revisions(revision)
+        stack = [root_position]
+        while stack:
+            position = stack.pop()
+            child_positions = children[position]
+            file = files[position]
+            file.revisions = [files[child] for child in child_positions]
+            file.revision_count = len(child_positions)
+            stack.extend(child_positions)
 
-        add_revisions(root)
+        root = files[root_position]
 
         return root
 
-    def flatten_revision_tree(self, root: Dict[str, Any]) -> List[Dict[str, Any]]:
+    def flatten_revision_tree(self, root: RevisionNode) -> List[RevisionNode]:
         """
         Flatten the revision tree starting from the root into a single list of files, preserving
         the original file order. Each file in the list will be followed by its revisions, recursively.
 
         Args:
-            root (Dict[str, Any]): The root file, typically the one with no `revises_id`,
-                                    which contains its revisions under the "revisions" key.
+            root (RevisionNode): The root file, typically the one with no `revises_id`,
+                                 as built by `build_revision_tree`.
 
         Returns:
-            List[Dict[str, Any]]: A flattened list of files, starting from the root, followed by its revisions.
+            List[RevisionNode]: A flattened list of files, starting from the root,
+                                followed by its revisions.
         """
         file_chain = []
 
-        def traverse(file):
-            # Add the current file to the flat list
+        # Depth-first traversal from the root using an explicit stack
+        stack = [root]
+        while stack:
+            file = stack.pop()
             file_chain.append(file)
 
-            sorted_revisions = sorted(
-                file.get("revisions", []), key=lambda x: len(x.get("revisions", []))
-            )
-
-            for revision in sorted_revisions:
-                traverse(revision)
+            sorted_revisions = sorted(file.revisions, key=_by_revision_count)
 
-        # Start traversal from the root
-        traverse(root)
+            # Push in reverse so the revisions are popped in sorted order
+            stack.extend(reversed(sorted_revisions))
 
         return file_chain
 
-    def rename_files_in_sequence(self, chain: List[Dict[str, Any]]) -> None:
+    def rename_files_in_sequence(self, chain: List[RevisionNode]) -> None:
         """Rename files in the directory based on the ordered chain.
 
         Args:
-            chain (List[Dict[str, Any]]): Ordered chain of files.
+            chain (List[RevisionNode]): Ordered chain of files.
 
         Raises:
             Exception: If an error is encountered when renaming files, all changes are rolled back.
         """
 
+        # Work out every rename before touching the filesystem so the loops below
+        # only issue the rename calls. Files are first moved to unique hidden stage
+        # names, so a new name can never clash with a file that is still to be moved.
+        # The stage names keep the original name so an interrupted run can be undone.
+        # Where possible the renames are relative to the opened directory, so only
+        # the file names are resolved.
+        use_dir_fd = _SUPPORTS_OPEN_DIR_FD and _SUPPORTS_RENAME_DIR_FD
+        directory_prefix = "" if use_dir_fd else os.path.join(self.directory, "")
+        stage_prefix = f"{directory_prefix}.stage_{uuid.uuid4().hex}_"
+        renames = []
+        add_rename = renames.append
+        for index, file_data in enumerate(chain, start=1):
+            new_name = f"{index}_{file_data.filename}"
+            add_rename(
+                (
+                    file_data,
+                    directory_prefix + file_data.filename,
+                    f"{stage_prefix}{index}_{file_data.filename}",
+                    new_name,
+                    directory_prefix + new_name,
+                )
+            )
+
+        # Bind the functions used in the loops to locals once
+        log_info = _logger.info
+        staged_files = []
+        renamed_files = []
+        add_staged_file = staged_files.append
+        add_renamed_file = renamed_files.append
+
+        # The directory is only opened once the plan is built, so nothing can fail
+        # between opening it and the try block that closes it.
+        dir_fd = _open_directory(self.directory) if use_dir_fd else None
+        if dir_fd is None:
+            replace = os.replace
+        else:
+            replace = functools.partial(
+                os.replace, src_dir_fd=dir_fd, dst_dir_fd=dir_fd
+            )
         try:
-            renamed_files = []
-            for index, file_data in enumerate(chain, start=1):
-                original_path = os.path.join(self.directory, file_data["filename"])
-                new_name = f"{index}_{file_data['filename']}"
-                new_path = os.path.join(self.directory, new_name)
-                os.rename(original_path, new_path)
-                renamed_files.append((new_path, original_path))
-                file_data["new_filename"] = new_name
-                _logger.info(f"Renamed {file_data['filename']} to {new_name}")
+            for file_data, original_path, stage_path, new_name, new_path in renames:
+                replace(original_path, stage_path)
+                add_staged_file((stage_path, original_path))
+
+            for file_data, original_path, stage_path, new_name, new_path in renames:
+                replace(stage_path, new_path)
+                add_renamed_file((new_path, stage_path))
+                file_data.new_filename = new_name
+                log_info(f"Renamed {file_data.filename} to {new_name}")
 
         except Exception as error:
             _logger.error(
@@ -176,20 +690,26 @@ class RevisionSequencer:
                 )
             )
 
-            for new_path, original_path in reversed(renamed_files):
-                os.rename(new_path, original_path)
+            for new_path, stage_path in reversed(renamed_files):
+                replace(new_path, stage_path)
+
+            for stage_path, original_path in reversed(staged_files):
+                replace(stage_path, original_path)
 
             _logger.info("Rollback complete. All files reverted to original names.")
 
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+
 
 def main():
     if len(sys.argv) == 1:
         _logger.error("No directory provided")
         raise ValueError("No directory provided")
     sequencer = RevisionSequencer(sys.argv[1])
-    files_data = list(sequencer.process_files())
-    tree = sequencer.build_revision_tree(files_data)
-    chain = sequencer.flatten_revision_tree(tree)
+    files_data = sequencer.process_files()
+    chain = sequencer.order_revisions(files_data)
     sequencer.rename_files_in_sequence(chain)
 
 
@@ -1,6 +1,10 @@
 import pytest
 import os
+import sys
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from file_sequencer import file_sequencer
 from file_sequencer.file_sequencer import RevisionSequencer
 
 
@@ -21,6 +25,20 @@ def create_test_file(directory, filename, revision_id=None, revises_id=None):
     return file_path
 
 
+def count_reads(monkeypatch):
+    reads = []
+    read_revision_data = file_sequencer._read_revision_data
+
+    def counting_read_revision_data(file_path, *args, **kwargs):
+        reads.append(file_path)
+        return read_revision_data(file_path, *args, **kwargs)
+
+    monkeypatch.setattr(
+        file_sequencer, "_read_revision_data", counting_read_revision_data
+    )
+    return reads
+
+
 @pytest.fixture
 def test_data(temp_directory):
     files = [
@@ -73,10 +91,131 @@ def test_extract_revision_data(test_data):
         assert revises_id == file["revises_id"]
 
 
+def test_extract_revision_data_without_simple_assignments(temp_directory):
+    file_path = os.path.join(temp_directory, "rev1.py")
+    with open(file_path, "w") as f:
+        f.write('"""Docstring."""\n')
+        f.write('revision_id: str = "rev1"\n')
+        f.write("revises_id = (\n    'rev0'\n)\n")
+    sequencer = RevisionSequencer(temp_directory)
+    assert sequencer.extract_revision_data(file_path) == ("rev1", "rev0")
+
+
+def test_extract_revision_data_escaped_literals(temp_directory):
+    file_path = os.path.join(temp_directory, "rev1.py")
+    with open(file_path, "w") as f:
+        f.write("revision_id = 'ab\\x41'\n")
+        f.write("revises_id = 'a\\\\'\n")
+    sequencer = RevisionSequencer(temp_directory)
+    assert sequencer.extract_revision_data(file_path) == ("abA", "a\\")
+
+
+def test_extract_revision_data_coding_cookie(temp_directory):
+    file_path = os.path.join(temp_directory, "rev1.py")
+    with open(file_path, "wb") as f:
+        f.write(b"# -*- coding: latin-1 -*-\n")
+        f.write(b"revision_id = '\xe9'\n")
+        f.write(b"revises_id = None\n")
+    sequencer = RevisionSequencer(temp_directory)
+    assert sequencer.extract_revision_data(file_path) == ("\xe9", None)
+
+
+def test_extract_revision_data_ignores_docstring_assignments(temp_directory):
+    file_path = os.path.join(temp_directory, "rev1.py")
+    with open(file_path, "w") as f:
+        f.write('"""\nrevision_id = \'fake\'\nrevises_id = None\n"""\n')
+        f.write('revision_id: str = "rev1"\n')
+        f.write('revises_id: str = "rev0"\n')
+    sequencer = RevisionSequencer(temp_directory)
+    assert sequencer.extract_revision_data(file_path) == ("rev1", "rev0")
+
+
+def test_extract_revision_data_docstring_uses_regex(temp_directory, monkeypatch):
+    file_path = os.path.join(temp_directory, "rev1.py")
+    with open(file_path, "w") as f:
+        f.write('"""Add the users table.\n\nrevision_id = fake\n"""\n')
+        f.write("revision_id = 'rev1'\n")
+        f.write("revises_id = None\n")
+
+    def parse_revision_data(source):
+        raise AssertionError("ast fallback used")
+
+    monkeypatch.setattr(file_sequencer, "_parse_revision_data", parse_revision_data)
+    sequencer = RevisionSequencer(temp_directory)
+    assert sequencer.extract_revision_data(file_path) == ("rev1", None)
+
+
+def test_extract_revision_data_non_literal_assignment(temp_directory):
+    file_path = os.path.join(temp_directory, "rev1.py")
+    with open(file_path, "w") as f:
+        f.write("revision_id = 'fake'\n")
+        f.write("revises_id = None\n")
+        f.write("revision_id = 'rev' + '1'\n")
+    sequencer = RevisionSequencer(temp_directory)
+    with pytest.raises(KeyError):
+        sequencer.extract_revision_data(file_path)
+
+
+def test_extract_revision_data_augmented_assignment(temp_directory):
+    file_path = os.path.join(temp_directory, "rev1.py")
+    with open(file_path, "w") as f:
+        f.write("revision_id = 'a'\n")
+        f.write("revises_id = None\n")
+        f.write("revision_id += 'x'\n")
+    sequencer = RevisionSequencer(temp_directory)
+    with pytest.raises(KeyError):
+        sequencer.extract_revision_data(file_path)
+
+
+def test_extract_revision_data_tuple_assignment(temp_directory):
+    file_path = os.path.join(temp_directory, "rev1.py")
+    with open(file_path, "w") as f:
+        f.write("revision_id, revises_id = 'a', None\n")
+    sequencer = RevisionSequencer(temp_directory)
+    assert sequencer.extract_revision_data(file_path) == ("a", None)
+
+
+def test_extract_revision_data_large_file(temp_directory):
+    file_path = os.path.join(temp_directory, "rev1.py")
+    with open(file_path, "w") as f:
+        f.write("# padding\n" * 20000)
+        f.write("revision_id = 'rev1'\nrevises_id = None\n")
+    sequencer = RevisionSequencer(temp_directory)
+    assert sequencer.extract_revision_data(file_path) == ("rev1", None)
+
+
+def test_extract_revision_data_missing_key(temp_directory):
+    file_path = os.path.join(temp_directory, "rev1.py")
+    with open(file_path, "w") as f:
+        f.write("revision_id = 'rev1'\n")
+    sequencer = RevisionSequencer(temp_directory)
+    with pytest.raises(KeyError):
+        sequencer.extract_revision_data(file_path)
+
+
+def test_extract_revision_data_uses_cache(temp_directory, monkeypatch):
+    file_path = create_test_file(temp_directory, "rev2.py", "rev2", "rev1")
+    sequencer = RevisionSequencer(temp_directory)
+    assert sequencer.extract_revision_data(file_path) == ("rev2", "rev1")
+    reads = count_reads(monkeypatch)
+    assert sequencer.extract_revision_data(file_path) == ("rev2", "rev1")
+    assert reads == []
+
+
+def test_extract_revision_data_rereads_changed_file(temp_directory):
+    file_path = create_test_file(temp_directory, "rev2.py", "rev2", "rev1")
+    sequencer = RevisionSequencer(temp_directory)
+    assert sequencer.extract_revision_data(file_path) == ("rev2", "rev1")
+    create_test_file(temp_directory, "rev2.py", "rev2", "rev0")
+    stat_result = os.stat(file_path)
+    os.utime(file_path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 1))
+    assert sequencer.extract_revision_data(file_path) == ("rev2", "rev0")
+
+
 def test_process_files(test_data):
     temp_directory, files = test_data
     sequencer = RevisionSequencer(temp_directory)
-    files_data = list(sequencer.process_files())
+    files_data = sequencer.process_files()
     assert len(files_data) == len(files)
     for file_data, file in zip(files_data, files):
         assert file_data["filename"] == file["filename"]
@@ -84,25 +223,286 @@ def test_process_files(test_data):
         assert file_data["revises_id"] == file["revises_id"]
 
 
+def test_process_files_skips_hidden_files(test_data):
+    temp_directory, files = test_data
+    with open(os.path.join(temp_directory, ".hidden.py"), "w") as f:
+        f.write("not a revision file\n")
+    with open(os.path.join(temp_directory, "__init__.py"), "w") as f:
+        f.write("")
+    os.mkdir(os.path.join(temp_directory, "__pycache__"))
+    sequencer = RevisionSequencer(temp_directory)
+    files_data = sequencer.process_files()
+    assert len(files_data) == len(files)
+
+
+def test_process_files_follows_symlinks(test_data):
+    temp_directory, files = test_data
+    with tempfile.TemporaryDirectory() as other_directory:
+        target = create_test_file(other_directory, "target.py", "rev6", "rev5")
+        os.symlink(target, os.path.join(temp_directory, "rev6.py"))
+        sequencer = RevisionSequencer(temp_directory)
+        files_data = sequencer.process_files()
+        assert files_data[-1] == {
+            "filename": "rev6.py",
+            "revision_id": "rev6",
+            "revises_id": "rev5",
+        }
+
+
+def test_process_files_uses_cache_across_directory_descriptors(test_data, monkeypatch):
+    temp_directory, files = test_data
+    sequencer = RevisionSequencer(temp_directory)
+    sequencer.process_files()
+    reads = count_reads(monkeypatch)
+    extra_fd = os.open(temp_directory, os.O_RDONLY)
+    try:
+        files_data = sequencer.process_files()
+    finally:
+        os.close(extra_fd)
+    assert len(files_data) == len(files)
+    assert reads == []
+
+
+def test_process_files_invalid_file(test_data):
+    temp_directory, files = test_data
+    with open(os.path.join(temp_directory, "rev6.py"), "w") as f:
+        f.write("revision_id = 'rev6'\n")
+    sequencer = RevisionSequencer(temp_directory)
+    with pytest.raises(ValueError):
+        sequencer.process_files()
+
+
+def test_process_files_stops_at_first_invalid_file(temp_directory, monkeypatch):
+    for index in range(50):
+        create_test_file(temp_directory, f"rev{index:02}.py", f"rev{index}")
+    sequencer = RevisionSequencer(temp_directory)
+    extracted = []
+    futures = []
+    shutting_down = threading.Event()
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, *args, **kwargs):
+            future = super().submit(*args, **kwargs)
+            futures.append(future)
+            return future
+
+        def shutdown(self, *args, **kwargs):
+            shutting_down.set()
+            super().shutdown(*args, **kwargs)
+
+    def extract_revision_data(file_path, stat_result=None, dir_fd=None):
+        extracted.append(file_path)
+        if len(extracted) > 1:
+            # Hold the worker until process_files has cancelled the queued files
+            shutting_down.wait()
+        raise KeyError(file_path)
+
+    monkeypatch.setattr(file_sequencer, "_MAX_WORKERS", 1)
+    monkeypatch.setattr(file_sequencer, "ThreadPoolExecutor", RecordingExecutor)
+    monkeypatch.setattr(sequencer, "extract_revision_data", extract_revision_data)
+    with pytest.raises(ValueError):
+        sequencer.process_files()
+    # At most one more file starts before the rest are cancelled
+    assert len(extracted) <= 2
+    assert sum(not future.cancelled() for future in futures) == len(extracted)
+
+
+def test_process_files_empty_directory(temp_directory):
+    sequencer = RevisionSequencer(temp_directory)
+    with pytest.raises(ValueError):
+        sequencer.process_files()
+
+
 def test_flatten_revision_tree(test_data):
     temp_directory, files = test_data
     sequencer = RevisionSequencer(temp_directory)
-    files_data = list(sequencer.process_files())
+    files_data = sequencer.process_files()
     tree = sequencer.build_revision_tree(files_data)
     chain = sequencer.flatten_revision_tree(tree)
     assert len(chain) == len(files)
     for file_data, file in zip(chain, files):
-        assert file_data["filename"] == file["filename"]
-        assert file_data["revision_id"] == file["revision_id"]
-        assert file_data["revises_id"] == file["revises_id"]
+        assert file_data.filename == file["filename"]
+        assert file_data.revision_id == file["revision_id"]
+        assert file_data.revises_id == file["revises_id"]
+
+
+def test_flatten_deep_revision_tree(temp_directory):
+    depth = sys.getrecursionlimit() + 100
+    files_data = [
+        {
+            "filename": f"rev{index}.py",
+            "revision_id": f"rev{index}",
+            "revises_id": f"rev{index - 1}" if index else None,
+        }
+        for index in range(depth)
+    ]
+    sequencer = RevisionSequencer(temp_directory)
+    tree = sequencer.build_revision_tree(files_data)
+    chain = sequencer.flatten_revision_tree(tree)
+    assert [file.revision_id for file in chain] == [
+        file["revision_id"] for file in files_data
+    ]
+
+
+def test_order_revisions(test_data):
+    temp_directory, files = test_data
+    sequencer = RevisionSequencer(temp_directory)
+    files_data = sequencer.process_files()
+    chain = sequencer.order_revisions(files_data)
+    assert [file.filename for file in chain] == [file["filename"] for file in files]
+
+
+def test_order_revisions_linear_chain(temp_directory):
+    files_data = [
+        {"filename": "c.py", "revision_id": "rev3", "revises_id": "rev2"},
+        {"filename": "a.py", "revision_id": "rev1", "revises_id": None},
+        {"filename": "b.py", "revision_id": "rev2", "revises_id": "rev1"},
+    ]
+    sequencer = RevisionSequencer(temp_directory)
+    chain = sequencer.order_revisions(files_data)
+    assert [file.filename for file in chain] == ["a.py", "b.py", "c.py"]
+
+
+def test_order_revisions_none_revision_id(temp_directory):
+    files_data = [
+        {"filename": "a.py", "revision_id": "a", "revises_id": None},
+        {"filename": "b.py", "revision_id": None, "revises_id": "a"},
+    ]
+    sequencer = RevisionSequencer(temp_directory)
+    chain = sequencer.order_revisions(files_data)
+    assert [file.filename for file in chain] == ["a.py", "b.py"]
+
+
+def test_order_revisions_no_root(temp_directory):
+    files_data = [{"filename": "b.py", "revision_id": "rev2", "revises_id": "rev1"}]
+    sequencer = RevisionSequencer(temp_directory)
+    with pytest.raises(ValueError):
+        sequencer.order_revisions(files_data)
 
 
 def test_rename_files_in_sequence(test_data):
     temp_directory, files = test_data
     sequencer = RevisionSequencer(temp_directory)
-    files_data = list(sequencer.process_files())
+    files_data = sequencer.process_files()
     tree = sequencer.build_revision_tree(files_data)
     chain = sequencer.flatten_revision_tree(tree)
     sequencer.rename_files_in_sequence(chain)
     for index, file in enumerate(files, start=1):
         assert os.path.exists(os.path.join(temp_directory, file["new_filename"]))
+    assert [file.new_filename for file in chain] == [
+        file["new_filename"] for file in files
+    ]
+
+
+def test_rename_files_in_sequence_rollback(test_data):
+    temp_directory, files = test_data
+    sequencer = RevisionSequencer(temp_directory)
+    files_data = sequencer.process_files()
+    tree = sequencer.build_revision_tree(files_data)
+    chain = sequencer.flatten_revision_tree(tree)
+    os.remove(os.path.join(temp_directory, chain[-1].filename))
+    sequencer.rename_files_in_sequence(chain)
+    assert sorted(os.listdir(temp_directory)) == [
+        file["filename"] for file in files[:-1]
+    ]
+
+
+def test_rename_files_in_sequence_name_collision(temp_directory):
+    create_test_file(temp_directory, "a.py", "rev1")
+    create_test_file(temp_directory, "1_a.py", "rev2", "rev1")
+    sequencer = RevisionSequencer(temp_directory)
+    files_data = sequencer.process_files()
+    tree = sequencer.build_revision_tree(files_data)
+    chain = sequencer.flatten_revision_tree(tree)
+    sequencer.rename_files_in_sequence(chain)
+    assert sorted(os.listdir(temp_directory)) == ["1_a.py", "2_1_a.py"]
+    assert sequencer.extract_revision_data(
+        os.path.join(temp_directory, "2_1_a.py")
+    ) == ("rev2", "rev1")
+
+
+def test_rename_files_in_sequence_interrupted(test_data, monkeypatch):
+    temp_directory, files = test_data
+    sequencer = RevisionSequencer(temp_directory)
+    chain = sequencer.order_revisions(sequencer.process_files())
+    replace = os.replace
+    calls = []
+
+    def interrupted_replace(*args, **kwargs):
+        calls.append(args)
+        if len(calls) > len(chain):
+            raise KeyboardInterrupt
+        replace(*args, **kwargs)
+
+    monkeypatch.setattr(os, "replace", interrupted_replace)
+    with pytest.raises(KeyboardInterrupt):
+        sequencer.rename_files_in_sequence(chain)
+    staged_names = sorted(os.listdir(temp_directory))
+    assert [name.split("_", 3)[-1] for name in staged_names] == [
+        file["filename"] for file in files
+    ]
+    assert all(name.startswith(".stage_") for name in staged_names)
+
+
+def rename_with_spy(sequencer, monkeypatch):
+    replace = os.replace
+    calls = []
+
+    def spy_replace(src, dst, **kwargs):
+        calls.append((src, dst, kwargs))
+        replace(src, dst, **kwargs)
+
+    monkeypatch.setattr(os, "replace", spy_replace)
+    chain = sequencer.order_revisions(sequencer.process_files())
+    sequencer.rename_files_in_sequence(chain)
+    return calls
+
+
+@pytest.mark.skipif(
+    not (
+        file_sequencer._SUPPORTS_OPEN_DIR_FD and file_sequencer._SUPPORTS_RENAME_DIR_FD
+    ),
+    reason="dir_fd is not supported on this platform",
+)
+def test_rename_files_in_sequence_with_directory_descriptor(test_data, monkeypatch):
+    temp_directory, files = test_data
+    sequencer = RevisionSequencer(temp_directory)
+    calls = rename_with_spy(sequencer, monkeypatch)
+    assert all(os.sep not in src and os.sep not in dst for src, dst, _ in calls)
+    assert all("src_dir_fd" in kwargs for _, _, kwargs in calls)
+    assert sorted(os.listdir(temp_directory)) == [
+        file["new_filename"] for file in files
+    ]
+
+
+def test_rename_files_in_sequence_without_directory_descriptor(test_data, monkeypatch):
+    temp_directory, files = test_data
+    monkeypatch.setattr(file_sequencer, "_SUPPORTS_OPEN_DIR_FD", False)
+    monkeypatch.setattr(file_sequencer, "_SUPPORTS_RENAME_DIR_FD", False)
+    sequencer = RevisionSequencer(temp_directory)
+    calls = rename_with_spy(sequencer, monkeypatch)
+    assert all(
+        src.startswith(temp_directory) and dst.startswith(temp_directory)
+        for src, dst, _ in calls
+    )
+    assert all(kwargs == {} for _, _, kwargs in calls)
+    assert sorted(os.listdir(temp_directory)) == [
+        file["new_filename"] for file in files
+    ]
+
+
+def test_rename_files_in_sequence_invalid_chain_closes_directory(
+    temp_directory, monkeypatch
+):
+    opened = []
+    open_directory = file_sequencer._open_directory
+
+    def recording_open_directory(directory):
+        opened.append(directory)
+        return open_directory(directory)
+
+    monkeypatch.setattr(file_sequencer, "_open_directory", recording_open_directory)
+    sequencer = RevisionSequencer(temp_directory)
+    with pytest.raises(AttributeError):
+        sequencer.rename_files_in_sequence([{"filename": "rev1.py"}])
+    assert opened == []